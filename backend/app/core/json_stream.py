@@ -0,0 +1,99 @@
+import json
+
+
+class ParagraphStreamParser:
+    """
+    Incremental parser for the {"paragraphs": [...]} object streamed by the model.
+    feed() takes raw text deltas and returns every paragraph string that has been
+    closed since the previous call, so paragraphs are available before the
+    completion finishes (and survive a truncated response).
+    Text before the first '{' (prose, ```json fences) is ignored.
+    """
+
+    def __init__(self):
+        self.stack = []  # open containers: 'obj' or 'arr'
+        self.expect_key = False  # next string in the current object is a key
+        self.last_key = None
+        self.paragraphs_depth = None  # stack depth of the "paragraphs" array once opened
+        self.in_string = False
+        self.escape = False
+        self.string_buf = []
+        self.complete = False
+        self.paragraph_count = 0
+
+    def feed(self, delta: str) -> list:
+        emitted = []
+
+        for ch in delta:
+            if self.complete:
+                break
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                    self.string_buf.append(ch)
+                elif ch == '\\':
+                    self.escape = True
+                    self.string_buf.append(ch)
+                elif ch == '"':
+                    self.in_string = False
+                    value = self._end_string()
+                    if value is not None:
+                        emitted.append(value)
+                else:
+                    self.string_buf.append(ch)
+                continue
+
+            if not self.stack:
+                # Still outside the JSON object
+                if ch == '{':
+                    self._push('obj')
+                continue
+
+            if ch == '"':
+                self.in_string = True
+                self.string_buf = []
+            elif ch == '{':
+                self._push('obj')
+            elif ch == '[':
+                self._push('arr')
+            elif ch in '}]':
+                self.stack.pop()
+                if self.paragraphs_depth is not None and len(self.stack) < self.paragraphs_depth:
+                    self.paragraphs_depth = None
+                if not self.stack:
+                    self.complete = True
+                else:
+                    self.expect_key = False
+            elif ch == ':':
+                self.expect_key = False
+            elif ch == ',':
+                self.expect_key = self.stack[-1] == 'obj'
+
+        self.paragraph_count += len(emitted)
+        return emitted
+
+    def _push(self, kind: str):
+        is_paragraphs = (
+            kind == 'arr'
+            and len(self.stack) == 1
+            and self.last_key == 'paragraphs'
+        )
+        self.stack.append(kind)
+        self.expect_key = kind == 'obj'
+        if is_paragraphs:
+            self.paragraphs_depth = len(self.stack)
+
+    def _end_string(self):
+        """Handle a closed string token; return it if it is a paragraph"""
+        raw = ''.join(self.string_buf)
+        self.string_buf = []
+
+        if self.stack[-1] == 'obj' and self.expect_key:
+            if len(self.stack) == 1:
+                self.last_key = json.loads(f'"{raw}"', strict=False)
+            return None
+
+        if self.paragraphs_depth is not None and len(self.stack) == self.paragraphs_depth:
+            return json.loads(f'"{raw}"', strict=False)
+        return None
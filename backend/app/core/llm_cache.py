@@ -0,0 +1,210 @@
+import functools
+import json
+import logging
+import os
+import struct
+import orjson
+from decouple import config
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# Cached chunk results are valid for 30 days
+CACHE_TTL = 60 * 60 * 24 * 30
+
+EMBEDDING_MODEL = 'text-embedding-3-small'
+EMBEDDING_DIM = 1536
+# A chunk is embedded from evenly spaced samples across its whole length (2000 chars total),
+# not just its start - otherwise every book's first chunk embeds the same licence header
+EMBEDDING_SAMPLES = 8
+EMBEDDING_SAMPLE_CHARS = 250
+
+SEMANTIC_INDEX = 'idx:llm_chunks'
+SEMANTIC_PREFIX = 'llmcache:vec:'
+
+
+def cache_llm(key_fn):
+    """
+    Two-tier cache for async chunk-processing methods of OpenAIService.
+    Tier 1: exact key from key_fn(self, text_chunk, ...) in the Django cache.
+    Tier 2 (opt-in, OPENAI_SEMANTIC_CACHE): nearest-neighbour lookup of the chunk
+    embedding in a RediSearch HNSW index, accepted above a cosine threshold.
+    The wrapped method returns (result, cacheable) and callers get just result; only
+    cacheable results (a completion that finished) are stored, so a truncated response
+    is not served again. Cache and embedding errors count as misses; exceptions from
+    the wrapped method propagate untouched.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, text_chunk, *args, **kwargs):
+            key = f"llmcache:exact:{key_fn(self, text_chunk, *args)}"
+
+            cached = await _cache_get(key)
+            if cached is not None:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Cache hit (exact) for chunk key %s", key[-12:])
+                return cached
+
+            semantic = SemanticCache.from_config()
+            embedding = None
+            if semantic:
+                try:
+                    embedding = await semantic.embed(self.aclient, text_chunk)
+                    cached = await semantic.lookup(self.model, embedding)
+                except Exception as e:
+                    logger.warning("Semantic cache lookup failed, treating as a miss: %s", e)
+                    cached = None
+                if cached is not None:
+                    logger.debug("Cache hit (semantic)")
+                    await _cache_set(key, cached)
+                    return cached
+
+            result, cacheable = await func(self, text_chunk, *args, **kwargs)
+
+            if cacheable:
+                await _cache_set(key, result)
+                if semantic and embedding is not None:
+                    await semantic.store(key, self.model, embedding, result)
+            return result
+        return wrapper
+    return decorator
+
+
+async def _cache_get(key: str):
+    """Exact-tier lookup; a cache backend error counts as a miss"""
+    try:
+        return await cache.aget(key)
+    except Exception as e:
+        logger.warning("Cache lookup failed, treating as a miss: %s", e)
+        return None
+
+
+async def _cache_set(key: str, value):
+    try:
+        await cache.aset(key, value, CACHE_TTL)
+    except Exception as e:
+        logger.warning("Cache store failed: %s", e)
+
+
+def _embedding_sample(text_chunk: str) -> str:
+    total = EMBEDDING_SAMPLES * EMBEDDING_SAMPLE_CHARS
+    if len(text_chunk) <= total:
+        return text_chunk
+    step = len(text_chunk) / EMBEDDING_SAMPLES
+    return '\n'.join(
+        text_chunk[int(i * step):int(i * step) + EMBEDDING_SAMPLE_CHARS]
+        for i in range(EMBEDDING_SAMPLES)
+    )
+
+
+class SemanticCache:
+    """Embedding similarity lookup backed by a RediSearch vector index"""
+
+    # Set once the index is known to exist, so lookups skip the FT.INFO round trip
+    _index_ready = False
+    # One instance (and Redis connection pool) per process, used only on its background event loop
+    _instance = None
+    _instance_pid = None
+
+    def __init__(self, redis_url: str, threshold: float):
+        # redis is only needed when the semantic tier is switched on
+        import redis.asyncio as redis
+
+        self.redis = redis.from_url(redis_url)
+        self.threshold = threshold
+
+    @classmethod
+    def from_config(cls):
+        """Return this process's SemanticCache if it is enabled and Redis is configured, else None"""
+        # False positives on book text silently return another chunk's paragraphs, so this is opt-in
+        if not config('OPENAI_SEMANTIC_CACHE', default=False, cast=bool):
+            return None
+        redis_url = config('REDIS_URL', default='')
+        if not redis_url:
+            return None
+        if cls._instance is None or cls._instance_pid != os.getpid():
+            try:
+                cls._instance = cls(redis_url, config('OPENAI_SEMANTIC_CACHE_THRESHOLD', default=0.97, cast=float))
+            except Exception as e:
+                logger.warning("Semantic cache unavailable: %s", e)
+                return None
+            cls._instance_pid = os.getpid()
+        return cls._instance
+
+    async def embed(self, aclient, text_chunk: str) -> list:
+        response = await aclient.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=_embedding_sample(text_chunk)
+        )
+        return response.data[0].embedding
+
+    async def lookup(self, model: str, embedding: list):
+        """Return cached paragraphs of the closest chunk for this model, or None"""
+        from redis.commands.search.query import Query
+
+        query = (
+            Query(f"(@model:{{{self._tag(model)}}})=>[KNN 1 @embedding $vec AS distance]")
+            .return_fields('paragraphs', 'distance')
+            .dialect(2)
+        )
+        try:
+            # Fails on a Redis without RediSearch - that is a miss, not a chunk failure
+            await self._ensure_index()
+            results = await self.redis.ft(SEMANTIC_INDEX).search(query, query_params={'vec': self._pack(embedding)})
+        except Exception as e:
+            logger.warning("Semantic cache lookup failed: %s", e)
+            return None
+
+        if not results.docs:
+            return None
+
+        doc = results.docs[0]
+        # COSINE distance in RediSearch is 1 - cosine similarity
+        similarity = 1 - float(doc.distance)
+        if similarity < self.threshold:
+            return None
+        return orjson.loads(doc.paragraphs)
+
+    async def store(self, key: str, model: str, embedding: list, paragraphs: list):
+        vector_key = SEMANTIC_PREFIX + key.rsplit(':', 1)[-1]
+        try:
+            await self.redis.hset(vector_key, mapping={
+                'model': self._tag(model),
+                'embedding': self._pack(embedding),
+                'paragraphs': json.dumps(paragraphs),
+            })
+            await self.redis.expire(vector_key, CACHE_TTL)
+        except Exception as e:
+            logger.warning("Semantic cache store failed: %s", e)
+
+    async def _ensure_index(self):
+        from redis.commands.search.field import TagField, VectorField
+        from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+
+        if SemanticCache._index_ready:
+            return
+        try:
+            await self.redis.ft(SEMANTIC_INDEX).info()
+        except Exception:
+            await self.redis.ft(SEMANTIC_INDEX).create_index(
+                [
+                    # paragraphs is stored in the hash but not indexed
+                    TagField('model'),
+                    VectorField('embedding', 'HNSW', {
+                        'TYPE': 'FLOAT32',
+                        'DIM': EMBEDDING_DIM,
+                        'DISTANCE_METRIC': 'COSINE',
+                    }),
+                ],
+                definition=IndexDefinition(prefix=[SEMANTIC_PREFIX], index_type=IndexType.HASH)
+            )
+        SemanticCache._index_ready = True
+
+    @staticmethod
+    def _pack(embedding: list) -> bytes:
+        return struct.pack(f"{len(embedding)}f", *embedding)
+
+    @staticmethod
+    def _tag(model: str) -> str:
+        # TAG values cannot contain punctuation used by the query syntax
+        return model.replace('-', '_').replace('.', '_').replace(':', '_')
@@ -1,81 +1,244 @@
+import asyncio
+import atexit
+import hashlib
 import json
+import logging
+import os
+import re
+import threading
+import time
+import httpx
+import orjson
 from decouple import config
-from openai import OpenAI
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    AsyncOpenAI,
+    InternalServerError,
+    OpenAI,
+    RateLimitError,
+)
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+from .json_stream import ParagraphStreamParser
+from .llm_cache import cache_llm
+
+logger = logging.getLogger(__name__)
+
+# Keep-alive pool shared by every OpenAIService instance in this worker, so chunk
+# calls reuse warm TCP/TLS connections instead of paying a handshake each time
+_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30.0)
+_SHARED_HTTP = httpx.Client(limits=_HTTP_LIMITS)
+atexit.register(_SHARED_HTTP.close)
+
+# Structured outputs schema - the model can only return {"paragraphs": [str, ...]}
+PARAGRAPHS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "ParagraphList",
+        "schema": {
+            "type": "object",
+            "properties": {
+                "paragraphs": {
+                    "type": "array",
+                    "items": {"type": "string"}
+                }
+            },
+            "required": ["paragraphs"],
+            "additionalProperties": False
+        },
+        "strict": True
+    }
+}
+
+# Errors worth retrying a chunk for; anything else fails the chunk straight away.
+# The async client's own retries are disabled (max_retries=0) so this is the only retry
+# layer for realtime calls; the sync client used by the batch path keeps the SDK's retries.
+# The SDK only wraps transport errors raised while sending the request - a connection that
+# drops mid-stream surfaces as a raw httpx.TransportError (ReadTimeout, RemoteProtocolError, ...)
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError, httpx.TransportError)
+
+_BACKOFF = wait_exponential_jitter(initial=1, max=30)
+# x-ratelimit-reset-* headers look like "1s", "6m0s", "20ms"
+_RE_RESET_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_RESET_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def _wait_for_rate_limit(retry_state) -> float:
+    """Wait as long as the server asks (retry-after / x-ratelimit-reset-requests), else back off"""
+    error = retry_state.outcome.exception()
+    response = getattr(error, 'response', None)
+    headers = response.headers if response is not None else {}
+
+    retry_after = headers.get('retry-after')
+    if retry_after:
+        try:
+            return min(float(retry_after), 60.0)
+        except ValueError:
+            pass
+
+    reset = headers.get('x-ratelimit-reset-requests')
+    if reset:
+        parts = _RE_RESET_PART.findall(reset)
+        if parts:
+            return min(sum(float(value) * _RESET_UNITS[unit] for value, unit in parts), 60.0)
+
+    return _BACKOFF(retry_state)
+
+
+def _log_retry(retry_state):
+    error = retry_state.outcome.exception()
+    logger.warning(
+        "OpenAI call failed (%s: %s), retry %d in %.1fs",
+        type(error).__name__, error, retry_state.attempt_number, retry_state.next_action.sleep
+    )
+
+
+# Batch states after which OpenAI does no more work (or billing) on a batch
+BATCH_TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+# Minimal prompt for the fine-tuned extraction model, which learned the rules from training data
+FINETUNED_PROMPT = "Extract paragraphs:\n\n"
+
+_TRAINING_LOG_LOCK = threading.Lock()
+
+_SHARED_CLIENTS = {}
+_SHARED_CLIENTS_LOCK = threading.Lock()
+
+
+def _get_shared_client(api_key: str) -> OpenAI:
+    """Return the process-wide OpenAI client for this key (created on first use)"""
+    with _SHARED_CLIENTS_LOCK:
+        if api_key not in _SHARED_CLIENTS:
+            # SDK default retries: the batch calls made with this client are not wrapped in tenacity
+            _SHARED_CLIENTS[api_key] = OpenAI(api_key=api_key, http_client=_SHARED_HTTP)
+        return _SHARED_CLIENTS[api_key]
+
+
+# One long-lived event loop per worker process runs every realtime chunk call, so the
+# AsyncOpenAI client (and its connection pool) outlives a single book like the sync one
+_LOOP = None
+_LOOP_PID = None
+_LOOP_LOCK = threading.Lock()
+_SHARED_ASYNC_HTTP = None
+_SHARED_ASYNC_CLIENTS = {}
+# Caps in-flight chunk requests across every book this worker is processing, not per book
+_CHUNK_SEMAPHORE = None
+
+
+def _get_event_loop() -> asyncio.AbstractEventLoop:
+    """Return this process's background event loop, starting it on first use (and after a fork)"""
+    global _LOOP, _LOOP_PID, _SHARED_ASYNC_HTTP, _CHUNK_SEMAPHORE
+    with _LOOP_LOCK:
+        if _LOOP is None or _LOOP_PID != os.getpid():
+            # A forked worker inherits the parent's loop object but not the thread running it
+            _SHARED_ASYNC_HTTP = None
+            _CHUNK_SEMAPHORE = None
+            _SHARED_ASYNC_CLIENTS.clear()
+            _LOOP = asyncio.new_event_loop()
+            _LOOP_PID = os.getpid()
+            threading.Thread(target=_LOOP.run_forever, name='openai-event-loop', daemon=True).start()
+        return _LOOP
+
+
+def _run_async(coro, timeout=None):
+    """Run a coroutine on the background loop from sync code and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, _get_event_loop()).result(timeout)
+
+
+def _get_shared_async_http() -> httpx.AsyncClient:
+    """Return the async keep-alive pool; only use it on the background loop"""
+    global _SHARED_ASYNC_HTTP
+    with _LOOP_LOCK:
+        if _SHARED_ASYNC_HTTP is None:
+            _SHARED_ASYNC_HTTP = httpx.AsyncClient(limits=_HTTP_LIMITS)
+        return _SHARED_ASYNC_HTTP
+
+
+def _get_shared_async_client(api_key: str) -> AsyncOpenAI:
+    """Return the process-wide AsyncOpenAI client for this key; only use it on the background loop"""
+    http_client = _get_shared_async_http()
+    with _LOOP_LOCK:
+        if api_key not in _SHARED_ASYNC_CLIENTS:
+            _SHARED_ASYNC_CLIENTS[api_key] = AsyncOpenAI(
+                api_key=api_key,
+                http_client=http_client,
+                max_retries=0  # retries are handled by tenacity (_stream_completion)
+            )
+        return _SHARED_ASYNC_CLIENTS[api_key]
 
-class OpenAIService:
-    """Secure OpenAI API service (backend only) - using OpenAI SDK"""
 
-    def __init__(self):
-        self.api_key = config('OPENAI_API_KEY')
-        # Try to get model from env, fallback to gpt-4o
-        self.model = config('OPENAI_MODEL', default='gpt-4o')
-        self.client = OpenAI(api_key=self.api_key)
-        print(f"OpenAI Service initialized with model: {self.model}")
+def _get_chunk_semaphore(limit: int) -> asyncio.Semaphore:
+    """Return the process-wide chunk request semaphore; only use it on the background loop"""
+    global _CHUNK_SEMAPHORE
+    with _LOOP_LOCK:
+        if _CHUNK_SEMAPHORE is None:
+            _CHUNK_SEMAPHORE = asyncio.Semaphore(limit)
+        return _CHUNK_SEMAPHORE
 
-    def process_book_text(self, book_text: str, chunk_index: int = 1, total_chunks: int = 1) -> dict:
-        """
-        Process book text and extract paragraphs
-        Uses same chunking logic as frontend: simple 200KB character chunks
-        Returns: {'paragraphs': [...], 'status': 'success'}
-        """
-        if not self.api_key:
-            raise ValueError("OPENAI_API_KEY not configured")
 
-        # Reduce chunk size to fit within gpt-4o's 128k INPUT token limit
-        # 200KB = ~50k tokens, but with prompt overhead it exceeds 128k
-        # Using 100KB chunks (~25k tokens) to stay safely under the limit
-        chunk_size = 100000
-        text_chunks = self._chunk_book_text(book_text, chunk_size)
-        all_paragraphs = []
+def _close_async_clients():
+    if _LOOP is None or _LOOP_PID != os.getpid():
+        return
+    for aclient in list(_SHARED_ASYNC_CLIENTS.values()):
+        try:
+            _run_async(aclient.close(), timeout=5)
+        except Exception:
+            pass
 
-        print(f"Book text split into {len(text_chunks)} chunks of ~{chunk_size / 1000}KB each")
 
-        for sub_chunk_index, text_chunk in enumerate(text_chunks, 1):
-            print(f"Processing chunk {sub_chunk_index}/{len(text_chunks)}, size: {round(len(text_chunk) / 1000)}KB")
+atexit.register(_close_async_clients)
 
-            paragraphs = self._process_single_chunk(
-                text_chunk,
-                chunk_index,
-                total_chunks,
-                sub_chunk_index,
-                len(text_chunks)
-            )
 
-            all_paragraphs.extend(paragraphs)
-            print(f"Chunk {sub_chunk_index}: Extracted {len(paragraphs)} paragraphs (Total so far: {len(all_paragraphs)})")
+async def _prewarm_async():
+    api_key = config('OPENAI_API_KEY', default='')
+    if not api_key:
+        return
+    try:
+        await _get_shared_async_http().head(
+            "https://api.openai.com/v1/models",
+            headers={"Authorization": f"Bearer {api_key}"},
+            timeout=5
+        )
+    except Exception as e:
+        logger.info("OpenAI connection pre-warm failed: %s", e)
 
-        return {
-            'status': 'success',
-            'paragraphs': all_paragraphs,
-            'total_paragraphs': len(all_paragraphs),
-        }
 
-    def _chunk_book_text(self, text: str, chunk_size: int = 200000) -> list:
-        """
-        EXACT SAME LOGIC AS FRONTEND:
-        const chunks: string[] = [];
-        let currentIndex = 0;
-        while (currentIndex < text.length) {
-            const chunk = text.substring(currentIndex, currentIndex + chunkSize);
-            chunks.push(chunk);
-            currentIndex += chunkSize;
-        }
-        """
-        chunks = []
-        current_index = 0
+_PREWARM_REQUESTED = False
 
-        while current_index < len(text):
-            chunk = text[current_index:current_index + chunk_size]
-            chunks.append(chunk)
-            current_index += chunk_size
 
-        return chunks
+def prewarm_connection():
+    """
+    Open a TCP/TLS connection to api.openai.com in the async pool used by the realtime
+    path, so the worker's first chunk call can reuse it. Fire-and-forget: it runs on
+    the background loop and never blocks the caller. Call it only from server
+    entrypoints (wsgi.py / asgi.py), not from management commands.
+    Under gunicorn --preload this runs in the master, so it is repeated in every forked
+    worker (see _after_fork_in_child), which starts its own loop and pool.
+    """
+    global _PREWARM_REQUESTED
+    if config('OPENAI_PREWARM', default=True, cast=bool):
+        _PREWARM_REQUESTED = True
+        _schedule_prewarm()
 
-    def _process_single_chunk(self, book_text: str, chunk_index: int, total_chunks: int, sub_index: int, sub_total: int) -> list:
-        """Process a single chunk using OpenAI SDK - EXACT SAME AS FRONTEND"""
 
-        # EXACT same prompt as frontend
-        prompt = f"""You are a text processing assistant. Analyze the following book text and extract all paragraphs.
+def _schedule_prewarm():
+    asyncio.run_coroutine_threadsafe(_prewarm_async(), _get_event_loop())
+
+
+def _after_fork_in_child():
+    global _LOOP_LOCK
+    # Only the forking thread survives, so the parent's loop thread may have held this lock
+    _LOOP_LOCK = threading.Lock()
+    if _PREWARM_REQUESTED:
+        _schedule_prewarm()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+# Sent verbatim as the first message of every chunk request. Keeping it byte-identical
+# (no per-chunk values) lets OpenAI's automatic prefix caching discount these tokens.
+STATIC_INSTRUCTIONS = """You are a text processing assistant. Analyze the book text in the user message and extract all paragraphs.
 
 CRITICAL REQUIREMENTS - FOLLOW EXACTLY:
 1. Each paragraph MUST be between 3-7 sentences (NO MORE, NO LESS)
@@ -96,124 +259,500 @@ PARAGRAPH SIZE RULES:
 - If original paragraph is 15 sentences, split it into 3 paragraphs of 5 sentences each
 
 Return ONLY a valid JSON object in this exact format with no additional text:
-{{
+{
   "paragraphs": [
     "First paragraph text here...",
     "Second paragraph text here..."
   ]
-}}
+}"""
 
-Book text (Chunk {sub_index}/{sub_total}):
-{book_text}"""
+# Part of every chunk cache key, so editing the prompts or the schema invalidates old results
+PROMPT_DIGEST = hashlib.sha256(
+    (STATIC_INSTRUCTIONS + FINETUNED_PROMPT + json.dumps(PARAGRAPHS_RESPONSE_FORMAT, sort_keys=True)).encode()
+).hexdigest()
 
-        try:
-            # OpenAI call with timeout
-            print(f"Calling OpenAI API with model: {self.model}")
 
+def _chunk_cache_key(service, text_chunk: str, *_) -> str:
+    return hashlib.sha256(f"{service.model}\n{PROMPT_DIGEST}\n{text_chunk}".encode()).hexdigest()
+
+
+class OpenAIService:
+    """Secure OpenAI API service (backend only) - using OpenAI SDK"""
+
+    def __init__(self):
+        self.api_key = config('OPENAI_API_KEY')
+        # Try to get model from env, fallback to gpt-4o
+        self.model = config('OPENAI_MODEL', default='gpt-4o')
+        # Fine-tuned gpt-4o-mini trained on (chunk -> paragraphs) pairs from the gpt-4o path.
+        # OPENAI_USE_FINETUNED=False switches back to the full-prompt model above.
+        self.finetuned_model = config('OPENAI_FINETUNED_MODEL', default='')
+        if self.finetuned_model and config('OPENAI_USE_FINETUNED', default=True, cast=bool):
+            self.model = self.finetuned_model
+        # JSONL file that successful full-prompt responses are appended to, as fine-tuning data
+        self.training_log_path = config('OPENAI_TRAINING_LOG', default='')
+        self.client = _get_shared_client(self.api_key)
+        self.aclient = None
+        # Cap on in-flight chunk requests per worker (shared by concurrent books) so we stay
+        # under the account's RPM/TPM limits
+        self.max_concurrency = config('OPENAI_MAX_CONCURRENCY', default=5, cast=int)
+        # Book ingestion is not interactive, so it can go through the (half price) Batch API
+        self.use_batch_api = config('OPENAI_USE_BATCH_API', default=False, cast=bool)
+        self.batch_poll_interval = config('OPENAI_BATCH_POLL_INTERVAL', default=10, cast=int)
+        self.batch_timeout = config('OPENAI_BATCH_TIMEOUT', default=900, cast=int)
+        logger.debug("OpenAI Service initialized with model: %s", self.model)
+
+    def process_book_text(self, book_text: str, chunk_index: int = 1, total_chunks: int = 1) -> dict:
+        """
+        Process book text and extract paragraphs
+        Uses the Batch API when OPENAI_USE_BATCH_API is set, realtime calls otherwise
+        Returns: {'paragraphs': [...], 'status': 'success'}
+        """
+        if self.use_batch_api:
+            return self.process_book_text_batch(book_text, chunk_index, total_chunks)
+        return self.process_book_text_realtime(book_text, chunk_index, total_chunks)
+
+    def process_book_text_realtime(self, book_text: str, chunk_index: int = 1, total_chunks: int = 1) -> dict:
+        """
+        Process book text with concurrent chat completion calls
+        Chunks are ~100KB, cut on paragraph boundaries (see _chunk_book_text)
+        Returns: {'paragraphs': [...], 'status': 'success'}
+        """
+        chunk_offsets, chunk_sources = self._split_book_text(book_text)
+
+        results = _run_async(self._process_chunks_concurrently(book_text, chunk_offsets, chunk_index, total_chunks))
+
+        for paragraphs in results:
+            if isinstance(paragraphs, BaseException):
+                raise paragraphs
+
+        return self._build_result(results, chunk_sources)
+
+    def process_book_text_batch(self, book_text: str, chunk_index: int = 1, total_chunks: int = 1) -> dict:
+        """
+        Process book text through the OpenAI Batch API
+        All chunks are submitted as one JSONL batch and polled until it finishes
+        Returns: {'paragraphs': [...], 'status': 'success'}
+        """
+        chunk_offsets, chunk_sources = self._split_book_text(book_text)
+        sub_total = len(chunk_offsets)
+
+        lines = []
+        for sub_chunk_index, (start, end) in enumerate(chunk_offsets, 1):
+            lines.append(orjson.dumps({
+                'custom_id': f"chunk-{sub_chunk_index}",
+                'method': 'POST',
+                'url': '/v1/chat/completions',
+                'body': self._build_completion_params(book_text[start:end], sub_chunk_index, sub_total),
+            }))
+        payload = b'\n'.join(lines) + b'\n'
+
+        batch_file = None
+        batch = None
+        try:
             try:
-                completion = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
-                    max_completion_tokens=16000,  # Maximum supported by most models
-                    timeout=180  # 3 minute timeout for API call
+                batch_file = self.client.files.create(file=('book_chunks.jsonl', payload), purpose='batch')
+                batch = self.client.batches.create(
+                    input_file_id=batch_file.id,
+                    endpoint='/v1/chat/completions',
+                    completion_window='24h'
                 )
             except Exception as api_error:
-                print(f"OpenAI API Error: {str(api_error)}")
-                raise Exception(f"OpenAI API call failed: {str(api_error)}")
+                logger.error("OpenAI API Error: %s", api_error)
+                raise Exception(f"OpenAI batch submission failed: {str(api_error)}")
+
+            logger.info("Submitted batch %s with %d chunks", batch.id, sub_total)
+
+            # The completion window is 24h but this runs inside an HTTP request, so give up
+            # (and cancel the batch, below) after OPENAI_BATCH_TIMEOUT instead of holding the worker
+            deadline = time.monotonic() + self.batch_timeout
+            while batch.status not in BATCH_TERMINAL_STATUSES:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Exception(f"OpenAI batch {batch.id} did not finish within {self.batch_timeout}s, cancelled")
+                time.sleep(min(self.batch_poll_interval, remaining))
+                batch = self.client.batches.retrieve(batch.id)
+                logger.info("Batch %s status: %s", batch.id, batch.status)
+
+            if batch.status != 'completed' or not batch.output_file_id:
+                raise Exception(f"OpenAI batch {batch.id} did not complete (status: {batch.status})")
+
+            output = self.client.files.content(batch.output_file_id).text
+        finally:
+            # Any failure while the batch is still running (timeout, a polling or download error)
+            # would otherwise leave it billing in the background
+            if batch is not None and batch.status not in BATCH_TERMINAL_STATUSES:
+                self._cancel_batch(batch)
+            self._delete_batch_files(batch_file, batch)
+
+        # Output lines are not guaranteed to be in input order, reassemble by custom_id
+        results_by_id = {}
+        for line in output.splitlines():
+            if line.strip():
+                item = orjson.loads(line)
+                results_by_id[item['custom_id']] = item
+
+        results = []
+        for sub_chunk_index in range(1, sub_total + 1):
+            item = results_by_id.get(f"chunk-{sub_chunk_index}")
+            response = (item or {}).get('response') or {}
+            if not item or item.get('error') or response.get('status_code') != 200:
+                error = (item or {}).get('error') or response.get('body', {}).get('error')
+                raise Exception(f"Failed to process chunk {sub_chunk_index}/{sub_total}: {error or 'missing from batch output'}")
+
+            choice = response['body']['choices'][0]
+            text_content = choice['message'].get('content') or ""
+            finish_reason = choice.get('finish_reason')
+
+            logger.debug(
+                "Chunk %d response length: %d, finish reason: %s",
+                sub_chunk_index, len(text_content), finish_reason,
+                extra={'chunk': sub_chunk_index, 'finish_reason': finish_reason}
+            )
+
+            try:
+                paragraphs = self._parse_chunk_response(text_content, finish_reason, sub_chunk_index, sub_total)
+            except Exception as e:
+                raise Exception(f"Failed to process chunk {sub_chunk_index}/{sub_total}: {str(e)}")
 
-            text_content = completion.choices[0].message.content or ""
-            finish_reason = completion.choices[0].finish_reason
+            if paragraphs and finish_reason == "stop":
+                start, end = chunk_offsets[sub_chunk_index - 1]
+                self._record_training_example(book_text[start:end], paragraphs)
+            results.append(paragraphs)
+
+        return self._build_result(results, chunk_sources)
+
+    def _cancel_batch(self, batch):
+        try:
+            self.client.batches.cancel(batch.id)
+        except Exception as e:
+            logger.warning("Could not cancel batch %s: %s", batch.id, e)
+
+    def _delete_batch_files(self, batch_file, batch):
+        """Remove the uploaded input and any output/error files of a batch; best effort"""
+        file_ids = [batch_file.id if batch_file else None]
+        if batch is not None:
+            # A cancelled batch may only produce its output file later; that one is left behind
+            file_ids += [getattr(batch, 'output_file_id', None), getattr(batch, 'error_file_id', None)]
+
+        for file_id in file_ids:
+            if not file_id:
+                continue
+            try:
+                self.client.files.delete(file_id)
+            except Exception as e:
+                logger.warning("Could not delete batch file %s: %s", file_id, e)
+
+    def _split_book_text(self, book_text: str) -> tuple:
+        """
+        Validate configuration and split the book into API-sized (start, end) chunk offsets.
+        Returns (unique_offsets, chunk_sources): only distinct chunks are sent to OpenAI, and
+        chunk_sources[i] is the position in unique_offsets whose result chunk i reuses.
+        """
+        if not self.api_key:
+            raise ValueError("OPENAI_API_KEY not configured")
+
+        # Reduce chunk size to fit within gpt-4o's 128k INPUT token limit
+        # 200KB = ~50k tokens, but with prompt overhead it exceeds 128k
+        # Using 100KB chunks (~25k tokens) to stay safely under the limit
+        chunk_size = 100000
+        chunk_offsets = self._chunk_book_text(book_text, chunk_size)
+
+        # A short tail (e.g. 5KB after two 100KB chunks) would cost a full round trip for very
+        # little text - fold it into the previous chunk while that stays well under the limit
+        if len(chunk_offsets) >= 2:
+            (prev_start, prev_end), (last_start, last_end) = chunk_offsets[-2:]
+            if last_end - last_start < chunk_size * 0.15 and last_end - prev_start <= chunk_size * 1.2:
+                chunk_offsets[-2:] = [(prev_start, last_end)]
+
+        logger.info("Book text split into %d chunks of ~%sKB each", len(chunk_offsets), chunk_size / 1000)
+
+        # Byte-identical chunks (filler, repeated boilerplate) are fingerprinted and sent once
+        unique_offsets = []
+        chunk_sources = []
+        seen = {}
+        for start, end in chunk_offsets:
+            digest = hashlib.blake2b(book_text[start:end].encode('utf-8'), digest_size=16).digest()
+            if digest not in seen:
+                seen[digest] = len(unique_offsets)
+                unique_offsets.append((start, end))
+            chunk_sources.append(seen[digest])
+
+        if len(unique_offsets) < len(chunk_offsets):
+            logger.info("Skipping %d duplicate chunks", len(chunk_offsets) - len(unique_offsets))
+
+        return unique_offsets, chunk_sources
+
+    def _build_result(self, results: list, chunk_sources: list) -> dict:
+        """Flatten per-chunk paragraph lists into the API response, in book order"""
+        all_paragraphs = []
 
-            print(f"Chunk {sub_index} response length: {len(text_content)}")
-            print(f"Chunk {sub_index} finish reason: {finish_reason}")
+        for sub_chunk_index, source in enumerate(chunk_sources, 1):
+            paragraphs = results[source]
+            all_paragraphs.extend(paragraphs)
+            logger.debug(
+                "Chunk %d: Extracted %d paragraphs (Total so far: %d)",
+                sub_chunk_index, len(paragraphs), len(all_paragraphs),
+                extra={'chunk': sub_chunk_index}
+            )
 
-            # If response is empty, this is a critical error
-            if not text_content or len(text_content) == 0:
-                error_msg = f"OpenAI returned empty response. Model: {self.model}, Finish reason: {finish_reason}"
-                print(f"ERROR: {error_msg}")
-                raise Exception(error_msg)
+        return {
+            'status': 'success',
+            'paragraphs': all_paragraphs,
+            'total_paragraphs': len(all_paragraphs),
+        }
 
-            # Check if response is just plain text (no JSON) - this means the chunk had no extractable paragraphs
-            if '{' not in text_content or 'paragraphs' not in text_content:
-                print(f"WARNING: Chunk {sub_index} contains no extractable paragraphs (metadata/dedication/etc). Skipping.")
-                return []  # Return empty list for chunks with no paragraphs
+    async def _process_chunks_concurrently(self, book_text: str, chunk_offsets: list, chunk_index: int, total_chunks: int) -> list:
+        """
+        Dispatch every chunk to OpenAI at once, bounded by the worker-wide semaphore.
+        Returns one entry per chunk (paragraph list or exception), in chunk order.
+        """
+        sem = _get_chunk_semaphore(self.max_concurrency)
+        sub_total = len(chunk_offsets)
+
+        async def run(sub_chunk_index: int, start: int, end: int) -> list:
+            async with sem:
+                # Slice only once the worker is running, so at most max_concurrency chunk copies exist
+                text_chunk = book_text[start:end]
+                logger.debug(
+                    "Processing chunk %d/%d, size: %dKB",
+                    sub_chunk_index, sub_total, round(len(text_chunk) / 1000),
+                    extra={'chunk': sub_chunk_index}
+                )
+                return await self._process_single_chunk_async(
+                    text_chunk,
+                    chunk_index,
+                    total_chunks,
+                    sub_chunk_index,
+                    sub_total
+                )
 
-            if finish_reason == "length":
-                print(f"WARNING: Chunk {sub_index}/{sub_total} response was truncated, but continuing with partial results...")
+        # Runs on the worker's background loop, which owns the shared async client and its pool
+        self.aclient = _get_shared_async_client(self.api_key)
+        tasks = [run(i, start, end) for i, (start, end) in enumerate(chunk_offsets, 1)]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _chunk_book_text(self, text: str, chunk_size: int = 200000) -> list:
+        """
+        Returns (start, end) offsets into text rather than copies of each chunk.
+        Each cut is made at the last paragraph break (blank line) in the 10% before
+        chunk_size, so no sentence straddles two chunks and chunks stay at or under
+        chunk_size. Only if there is none does it take the first break in the 10%
+        after, and failing that a hard cut at chunk_size.
+        """
+        offsets = []
+        current_index = 0
+        window = chunk_size // 10
+
+        while current_index < len(text):
+            target = current_index + chunk_size
+            if target >= len(text):
+                offsets.append((current_index, len(text)))
+                break
+
+            end = self._last_paragraph_break(text, target - window, target)
+            if end == -1:
+                end = self._first_paragraph_break(text, target, min(target + window, len(text)))
+            if end == -1:
+                end = target
+
+            offsets.append((current_index, end))
+            current_index = end
+
+        return offsets
+
+    # '\r\n\r\n' covers the CRLF blank lines used by Project Gutenberg texts
+    _PARAGRAPH_BREAKS = ('\n\n', '\r\n\r\n')
+
+    def _last_paragraph_break(self, text: str, start: int, end: int) -> int:
+        """Offset just after the last blank line fully inside text[start:end], or -1"""
+        best = -1
+        for sep in self._PARAGRAPH_BREAKS:
+            pos = text.rfind(sep, start, end)
+            if pos != -1:
+                best = max(best, pos + len(sep))
+        return best
+
+    def _first_paragraph_break(self, text: str, start: int, end: int) -> int:
+        """Offset just after the first blank line fully inside text[start:end], or -1"""
+        best = -1
+        for sep in self._PARAGRAPH_BREAKS:
+            pos = text.find(sep, start, end)
+            if pos != -1 and (best == -1 or pos + len(sep) < best):
+                best = pos + len(sep)
+        return best
+
+    @cache_llm(key_fn=_chunk_cache_key)
+    async def _process_single_chunk_async(self, book_text: str, chunk_index: int, total_chunks: int, sub_index: int, sub_total: int) -> list:
+        """
+        Process a single chunk using OpenAI SDK
+        Returns (paragraphs, cacheable) - cacheable only when the completion finished normally
+        """
+
+        try:
+            # OpenAI call with timeout
+            logger.debug("Calling OpenAI API with model: %s", self.model, extra={'chunk': sub_index})
 
-            # EXACT same JSON parsing logic as frontend
-            parsed_response = None
             try:
-                parsed_response = json.loads(text_content)
-            except json.JSONDecodeError as parse_error:
-                print(f"Failed to parse JSON for chunk {sub_index}/{sub_total}: {parse_error}")
-                print(f"Response preview (first 500 chars): {text_content[:500]}")
-
-                json_text = text_content
-
-                # Try markdown code blocks
-                if '```json' in text_content:
-                    import re
-                    json_match = re.search(r'```json\s*([\s\S]*?)\s*```', text_content)
-                    if json_match:
-                        json_text = json_match.group(1)
-                        print("Extracted JSON from ```json block")
-                elif '```' in text_content:
-                    import re
-                    json_match = re.search(r'```\s*([\s\S]*?)\s*```', text_content)
-                    if json_match:
-                        json_text = json_match.group(1)
-                        print("Extracted JSON from ``` block")
-
-                # Extract JSON object - try to find the most complete JSON
-                import re
-
-                # First, try to find JSON with proper structure
-                json_object_match = re.search(r'\{\s*"paragraphs"\s*:\s*\[[\s\S]*?\]\s*\}', json_text)
-
-                if not json_object_match:
-                    # Fallback: try any JSON object
-                    json_object_match = re.search(r'\{[\s\S]*\}', json_text)
-
-                if not json_object_match:
-                    print("Full response text:", text_content)
-                    print("Could not find any JSON object in response")
-                    # If no JSON found but response has content, treat as no extractable paragraphs
-                    if text_content and len(text_content) > 0:
-                        print(f"WARNING: Chunk {sub_index} - treating as non-narrative content")
-                        return []
-                    raise Exception(f"Could not extract JSON from OpenAI response for chunk {sub_index}")
-
-                try:
-                    json_str = json_object_match.group(0)
-                    # Try to fix common JSON issues - incomplete arrays
-                    if json_str.count('[') > json_str.count(']'):
-                        json_str = json_str + ']' * (json_str.count('[') - json_str.count(']'))
-                    if json_str.count('{') > json_str.count('}'):
-                        json_str = json_str + '}' * (json_str.count('{') - json_str.count('}'))
-
-                    parsed_response = json.loads(json_str)
-                    print("Successfully parsed JSON after extraction")
-                except json.JSONDecodeError as e2:
-                    print(f"Failed to parse extracted JSON: {e2}")
-                    print(f"Extracted JSON preview: {json_object_match.group(0)[:500]}")
-                    print(f"Full response for debugging: {text_content}")
-                    # Treat as non-narrative content instead of crashing
-                    return []
-
-            if not parsed_response or not parsed_response.get('paragraphs') or not isinstance(parsed_response['paragraphs'], list):
-                raise Exception(f"Invalid response format for chunk {sub_index} - missing paragraphs array")
-
-            return parsed_response['paragraphs']
+                parser, paragraphs, text_content, finish_reason = await self._stream_completion(
+                    self._build_completion_params(book_text, sub_index, sub_total)
+                )
+            except Exception as api_error:
+                logger.error("OpenAI API Error: %s", api_error, extra={'chunk': sub_index})
+                raise Exception(f"OpenAI API call failed: {str(api_error)}")
+
+            logger.debug(
+                "Chunk %d response length: %d, finish reason: %s",
+                sub_index, len(text_content), finish_reason,
+                extra={'chunk': sub_index, 'finish_reason': finish_reason}
+            )
+
+            # A truncated (or otherwise unfinished) response must not be cached as the chunk's result.
+            # A full 100KB chunk is ~25k tokens to echo back against max_completion_tokens=16000, so
+            # those usually stop on "length" - in practice the cache mostly holds shorter (tail) chunks.
+            finished = finish_reason == "stop"
+
+            if paragraphs and parser.complete:
+                # File I/O off the shared loop, which is streaming every other chunk in this worker
+                await asyncio.to_thread(self._record_training_example, book_text, paragraphs)
+                return paragraphs, finished
+
+            if paragraphs and finish_reason == "length":
+                # Every paragraph closed before the cut-off is intact, keep those
+                logger.warning(
+                    "Chunk %d/%d response was truncated, keeping %d complete paragraphs",
+                    sub_index, sub_total, len(paragraphs)
+                )
+                return paragraphs, False
+
+            # No paragraphs streamed (empty list, truncation before the first one, or bad output)
+            return self._parse_chunk_response(text_content, finish_reason, sub_index, sub_total), finished
 
         except Exception as e:
-            print(f"EXCEPTION in _process_single_chunk: {str(e)}")
-            print(f"Exception type: {type(e).__name__}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Failed to process chunk %d/%d", sub_index, sub_total, extra={'chunk': sub_index})
             raise Exception(f"Failed to process chunk {sub_index}/{sub_total}: {str(e)}")
+
+    @retry(
+        retry=retry_if_exception_type(RETRYABLE_ERRORS),
+        wait=_wait_for_rate_limit,
+        stop=stop_after_attempt(6),
+        before_sleep=_log_retry,
+        reraise=True
+    )
+    async def _stream_completion(self, params: dict) -> tuple:
+        """
+        Stream one chat completion and pick paragraphs out of it as each array element closes.
+        Rate limits, timeouts and transient errors restart the stream after a backoff.
+        Returns (parser, paragraphs, text_content, finish_reason).
+        """
+        parser = ParagraphStreamParser()
+        paragraphs = []
+        text_parts = []
+        finish_reason = None
+
+        stream = await self.aclient.chat.completions.create(
+            **params,
+            stream=True,
+            timeout=180  # 3 minute timeout for API call
+        )
+        async for event in stream:
+            if not event.choices:
+                continue
+            choice = event.choices[0]
+            if choice.delta and choice.delta.content:
+                text_parts.append(choice.delta.content)
+                paragraphs.extend(parser.feed(choice.delta.content))
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+
+        return parser, paragraphs, ''.join(text_parts), finish_reason
+
+    def _build_completion_params(self, book_text: str, sub_index: int, sub_total: int) -> dict:
+        """Chat completion request body for one chunk, shared by the realtime and batch paths"""
+
+        if self._is_finetuned():
+            # The tuned model needs no instructions; the schema keeps the output parseable
+            return {
+                'model': self.model,
+                'messages': [
+                    {
+                        "role": "user",
+                        "content": FINETUNED_PROMPT + book_text
+                    }
+                ],
+                'response_format': PARAGRAPHS_RESPONSE_FORMAT,
+                'max_completion_tokens': 16000,
+            }
+
+        # Same instructions as frontend, static part first so the prompt prefix is cacheable
+        return {
+            'model': self.model,
+            'messages': [
+                {
+                    "role": "system",
+                    "content": STATIC_INSTRUCTIONS
+                },
+                {
+                    "role": "user",
+                    "content": f"Book text (Chunk {sub_index}/{sub_total}):\n{book_text}"
+                }
+            ],
+            'response_format': PARAGRAPHS_RESPONSE_FORMAT,
+            'max_completion_tokens': 16000,  # Maximum supported by most models
+        }
+
+    def _is_finetuned(self) -> bool:
+        return bool(self.finetuned_model) and self.model == self.finetuned_model
+
+    def _record_training_example(self, book_text: str, paragraphs: list):
+        """Append a (chunk -> paragraphs) pair in fine-tuning chat format to OPENAI_TRAINING_LOG"""
+        if not self.training_log_path or self._is_finetuned():
+            return
+
+        example = json.dumps({
+            'messages': [
+                {"role": "user", "content": FINETUNED_PROMPT + book_text},
+                {"role": "assistant", "content": json.dumps({'paragraphs': paragraphs})},
+            ]
+        })
+        try:
+            with _TRAINING_LOG_LOCK:
+                with open(self.training_log_path, 'a', encoding='utf-8') as f:
+                    f.write(example + '\n')
+        except OSError as e:
+            logger.warning("Could not write training example: %s", e)
+
+    def _parse_chunk_response(self, text_content: str, finish_reason: str, sub_index: int, sub_total: int) -> list:
+        """Turn the raw model output for one chunk into a list of paragraphs"""
+
+        # If response is empty, this is a critical error
+        if not text_content or len(text_content) == 0:
+            error_msg = f"OpenAI returned empty response. Model: {self.model}, Finish reason: {finish_reason}"
+            logger.error(error_msg)
+            raise Exception(error_msg)
+
+        if finish_reason == "length":
+            # The JSON is cut off mid-array, but every paragraph closed before that is intact
+            paragraphs = ParagraphStreamParser().feed(text_content)
+            if not paragraphs:
+                raise Exception(f"Chunk {sub_index} response was truncated before the first complete paragraph")
+            logger.warning(
+                "Chunk %d/%d response was truncated, keeping %d complete paragraphs",
+                sub_index, sub_total, len(paragraphs)
+            )
+            return paragraphs
+
+        # Structured outputs guarantee the schema, so anything unparseable is a real failure
+        try:
+            parsed_response = orjson.loads(text_content)
+        except orjson.JSONDecodeError as parse_error:
+            logger.error("Failed to parse JSON for chunk %d/%d: %s", sub_index, sub_total, parse_error)
+            raise
+
+        if not isinstance(parsed_response, dict) or not isinstance(parsed_response.get('paragraphs'), list):
+            raise Exception(f"Invalid response format for chunk {sub_index} - missing paragraphs array")
+
+        if not parsed_response['paragraphs']:
+            # Metadata/dedication/etc - the model reports no extractable paragraphs
+            logger.warning("Chunk %d contains no extractable paragraphs. Skipping.", sub_index)
+
+        return parsed_response['paragraphs']
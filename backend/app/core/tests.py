@@ -1,4 +1,14 @@
-from django.test import TestCase
+import json
+import os
+from types import SimpleNamespace
+from unittest import mock
+
+import httpx
+from django.test import SimpleTestCase, TestCase
+from openai import RateLimitError
+
+from .json_stream import ParagraphStreamParser
+from .services import OpenAIService, _wait_for_rate_limit
 
 # Create your tests here.
 # from django.test import TestCase, Client
@@ -21,4 +31,220 @@ from django.test import TestCase
 #         data = resp.json()
 #         self.assertTrue(isinstance(data, list))
 #         self.assertEqual(len(data), 1)
-#         self.assertEqual(data[0]['paragraph_id'], str(self.par.id).replace('-', ''))
\ No newline at end of file
+#         self.assertEqual(data[0]['paragraph_id'], str(self.par.id).replace('-', ''))
+
+
+class ParagraphStreamParserTest(SimpleTestCase):
+    DOCUMENT = '{"paragraphs": ["First one.", "Second one."]}'
+
+    def feed_all(self, deltas):
+        parser = ParagraphStreamParser()
+        paragraphs = []
+        for delta in deltas:
+            paragraphs.extend(parser.feed(delta))
+        return parser, paragraphs
+
+    def test_whole_document(self):
+        parser, paragraphs = self.feed_all([self.DOCUMENT])
+        self.assertEqual(paragraphs, ['First one.', 'Second one.'])
+        self.assertTrue(parser.complete)
+        self.assertEqual(parser.paragraph_count, 2)
+
+    def test_split_at_every_point(self):
+        for i in range(len(self.DOCUMENT) + 1):
+            parser, paragraphs = self.feed_all([self.DOCUMENT[:i], self.DOCUMENT[i:]])
+            self.assertEqual(paragraphs, ['First one.', 'Second one.'], f"split at {i}")
+            self.assertTrue(parser.complete)
+
+    def test_one_character_deltas(self):
+        parser, paragraphs = self.feed_all(list(self.DOCUMENT))
+        self.assertEqual(paragraphs, ['First one.', 'Second one.'])
+        self.assertTrue(parser.complete)
+
+    def test_escaped_quotes_and_backslashes(self):
+        document = r'{"paragraphs": ["He said \"no\" and left.", "C:\\books\\", "a\\\"b"]}'
+        expected = ['He said "no" and left.', 'C:\\books\\', 'a\\"b']
+        for i in range(len(document) + 1):
+            _, paragraphs = self.feed_all([document[:i], document[i:]])
+            self.assertEqual(paragraphs, expected, f"split at {i}")
+
+    def test_unicode_escapes(self):
+        document = r'{"paragraphs": ["Caf\u00e9 \ud83d\ude00", "line\nbreak\ttab"]}'
+        for i in range(len(document) + 1):
+            _, paragraphs = self.feed_all([document[:i], document[i:]])
+            self.assertEqual(paragraphs, ['Caf\u00e9 \U0001F600', 'line\nbreak\ttab'], f"split at {i}")
+
+    def test_round_trips_json_dumps_output(self):
+        expected = ['Quote " slash \\ tab \t', 'Nul\x00 and caf\u00e9 \U0001F600', '{"not": ["json"]}', '']
+        document = json.dumps({'paragraphs': expected})
+        for size in range(1, 8):
+            deltas = [document[i:i + size] for i in range(0, len(document), size)]
+            parser, paragraphs = self.feed_all(deltas)
+            self.assertEqual(paragraphs, expected, f"deltas of {size}")
+            self.assertTrue(parser.complete)
+
+    def test_truncated_inside_a_string(self):
+        parser, paragraphs = self.feed_all(['{"paragraphs": ["Complete.", "Cut off mid-sen'])
+        self.assertEqual(paragraphs, ['Complete.'])
+        self.assertFalse(parser.complete)
+
+    def test_truncated_inside_an_escape(self):
+        parser, paragraphs = self.feed_all(['{"paragraphs": ["Complete.", "Half an escape \\'])
+        self.assertEqual(paragraphs, ['Complete.'])
+        self.assertFalse(parser.complete)
+
+    def test_other_top_level_keys_are_ignored(self):
+        document = (
+            '{"title": "paragraphs", "notes": ["not a paragraph"], '
+            '"paragraphs": ["Kept."], "meta": {"paragraphs": ["nested"]}, "tail": "x"}'
+        )
+        parser, paragraphs = self.feed_all([document])
+        self.assertEqual(paragraphs, ['Kept.'])
+        self.assertTrue(parser.complete)
+
+    def test_prose_before_and_after_the_object(self):
+        parser, paragraphs = self.feed_all(['Sure!\n```json\n', self.DOCUMENT, '\n```', ' {"paragraphs": ["late"]}'])
+        self.assertEqual(paragraphs, ['First one.', 'Second one.'])
+        self.assertTrue(parser.complete)
+        self.assertEqual(parser.feed('more'), [])
+
+    def test_empty_paragraphs(self):
+        parser, paragraphs = self.feed_all(['{"paragraphs": []}'])
+        self.assertEqual(paragraphs, [])
+        self.assertTrue(parser.complete)
+
+
+
+def make_service():
+    with mock.patch.dict(os.environ, {'OPENAI_API_KEY': 'test-key'}):
+        return OpenAIService()
+
+
+def paragraph_text(count, sep='\n\n'):
+    """Paragraphs of 30-90 characters, so a 1000-character chunk always has a break in its last 10%"""
+    return sep.join(chr(ord('a') + i % 26) * (30 + (i * 37) % 61) for i in range(count))
+
+
+class ChunkBookTextTest(SimpleTestCase):
+    def setUp(self):
+        self.service = make_service()
+
+    def assertCoversText(self, text, offsets):
+        self.assertEqual(offsets[0][0], 0)
+        self.assertEqual(offsets[-1][1], len(text))
+        for (_, end), (start, _) in zip(offsets, offsets[1:]):
+            self.assertEqual(end, start)
+        self.assertEqual(''.join(text[start:end] for start, end in offsets), text)
+
+    def test_offsets_rebuild_the_text(self):
+        for text in (paragraph_text(200), paragraph_text(200, '\r\n\r\n'), 'x' * 3500, 'short', ''):
+            offsets = self.service._chunk_book_text(text, 1000)
+            if text:
+                self.assertCoversText(text, offsets)
+            else:
+                self.assertEqual(offsets, [])
+
+    def test_chunks_end_on_paragraph_breaks_within_chunk_size(self):
+        text = paragraph_text(200)
+        offsets = self.service._chunk_book_text(text, 1000)
+        self.assertGreater(len(offsets), 5)
+        for start, end in offsets[:-1]:
+            self.assertLessEqual(end - start, 1000)
+            self.assertGreaterEqual(end - start, 900)
+            self.assertEqual(text[end - 2:end], '\n\n')
+
+    def test_crlf_paragraph_breaks(self):
+        text = paragraph_text(200, '\r\n\r\n')
+        offsets = self.service._chunk_book_text(text, 1000)
+        for start, end in offsets[:-1]:
+            self.assertLessEqual(end - start, 1000)
+            self.assertEqual(text[end - 4:end], '\r\n\r\n')
+
+    def test_break_after_chunk_size_when_none_before(self):
+        text = 'a' * 1050 + '\n\n' + 'b' * 500
+        offsets = self.service._chunk_book_text(text, 1000)
+        self.assertEqual(offsets, [(0, 1052), (1052, len(text))])
+
+    def test_hard_cut_without_paragraph_breaks(self):
+        text = 'a' * 1200 + '\n\n' + 'b' * 1500
+        offsets = self.service._chunk_book_text(text, 1000)
+        self.assertEqual(offsets[0], (0, 1000))
+        self.assertCoversText(text, offsets)
+
+
+class SplitBookTextTest(SimpleTestCase):
+    def setUp(self):
+        self.service = make_service()
+
+    @staticmethod
+    def block(ch, size=100000):
+        """One full-size chunk that ends on a paragraph break"""
+        return ch * (size - 2) + '\n\n'
+
+    def test_requires_api_key(self):
+        self.service.api_key = ''
+        with self.assertRaises(ValueError):
+            self.service._split_book_text('text')
+
+    def test_short_tail_is_merged_into_previous_chunk(self):
+        text = self.block('a') + self.block('b') + 'c' * 5000
+        offsets, sources = self.service._split_book_text(text)
+        self.assertEqual(offsets, [(0, 100000), (100000, 205000)])
+        self.assertEqual(sources, [0, 1])
+
+    def test_longer_tail_is_kept_separate(self):
+        text = self.block('a') + self.block('b') + 'c' * 20000
+        offsets, _ = self.service._split_book_text(text)
+        self.assertEqual(offsets, [(0, 100000), (100000, 200000), (200000, 220000)])
+
+    def test_duplicate_chunks_are_sent_once(self):
+        text = self.block('a') + self.block('b') + self.block('a') + self.block('c') + self.block('b')
+        offsets, sources = self.service._split_book_text(text)
+        self.assertEqual(offsets, [(0, 100000), (100000, 200000), (300000, 400000)])
+        self.assertEqual(sources, [0, 1, 0, 2, 1])
+
+        result = self.service._build_result([['A'], ['B'], ['C']], sources)
+        self.assertEqual(result['paragraphs'], ['A', 'B', 'A', 'C', 'B'])
+        self.assertEqual(result['total_paragraphs'], 5)
+
+
+
+class WaitForRateLimitTest(SimpleTestCase):
+    @staticmethod
+    def retry_state(headers=None, attempt_number=1):
+        request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+        response = httpx.Response(429, headers=headers or {}, request=request)
+        error = RateLimitError('Rate limit reached', response=response, body=None)
+        return SimpleNamespace(outcome=SimpleNamespace(exception=lambda: error), attempt_number=attempt_number)
+
+    def test_retry_after_seconds(self):
+        self.assertEqual(_wait_for_rate_limit(self.retry_state({'retry-after': '7'})), 7.0)
+
+    def test_reset_requests_minutes_and_seconds(self):
+        # 6m0s is over the cap
+        self.assertEqual(_wait_for_rate_limit(self.retry_state({'x-ratelimit-reset-requests': '6m0s'})), 60.0)
+        self.assertAlmostEqual(_wait_for_rate_limit(self.retry_state({'x-ratelimit-reset-requests': '0m30s'})), 30.0)
+        self.assertAlmostEqual(_wait_for_rate_limit(self.retry_state({'x-ratelimit-reset-requests': '12.5s'})), 12.5)
+
+    def test_reset_requests_milliseconds(self):
+        self.assertAlmostEqual(_wait_for_rate_limit(self.retry_state({'x-ratelimit-reset-requests': '20ms'})), 0.02)
+
+    def test_non_numeric_retry_after_falls_through(self):
+        headers = {'retry-after': 'Wed, 21 Oct 2015 07:28:00 GMT', 'x-ratelimit-reset-requests': '2s'}
+        self.assertEqual(_wait_for_rate_limit(self.retry_state(headers)), 2.0)
+
+    def test_non_numeric_retry_after_without_reset_backs_off(self):
+        wait = _wait_for_rate_limit(self.retry_state({'retry-after': 'soon'}, attempt_number=1))
+        # First exponential backoff step: 1s plus up to 1s of jitter
+        self.assertGreaterEqual(wait, 1.0)
+        self.assertLessEqual(wait, 2.0)
+
+    def test_waits_are_capped_at_60_seconds(self):
+        self.assertEqual(_wait_for_rate_limit(self.retry_state({'retry-after': '3600'})), 60.0)
+        self.assertEqual(_wait_for_rate_limit(self.retry_state({'x-ratelimit-reset-requests': '1h'})), 60.0)
+
+    def test_errors_without_a_response_back_off(self):
+        state = SimpleNamespace(outcome=SimpleNamespace(exception=lambda: httpx.ReadTimeout('timed out')), attempt_number=2)
+        wait = _wait_for_rate_limit(state)
+        self.assertGreaterEqual(wait, 2.0)
+        self.assertLessEqual(wait, 3.0)
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
 
 application = get_wsgi_application()
+
+# Server processes only - open the OpenAI connection before the first book request
+from core.services import prewarm_connection  # noqa: E402
+
+prewarm_connection()